@@ -19,6 +19,12 @@ class Chatterstack:
         self.system_index = -1
         self.system_lock_index = None
 
+        self.retrieval = False
+        self.retrieval_top_k = 3
+        self.retrieval_token_budget = 500
+        self.retrieval_min_score = 0.2
+        self.message_index = None
+
         self.last_call_prompt_tokens=0
         self.last_call_full_context_prompt_tokens=0
         self.last_call_completion_tokens=0
@@ -45,6 +51,7 @@ class Chatterstack:
     def add(self, role, content):
         new_dict = {"role": role, "content": content}
         self.list.insert(len(self.list), new_dict)
+        self.index_message(new_dict)
     
     def add_system(self, content):
         """Add a system message with specified content to the end of the conversation."""
@@ -109,9 +116,9 @@ class Chatterstack:
                 return
             while len(self.list) > self.max_length:
                 if self.system_index > 0:
-                    self.remove_from_start(1)
+                    self.remove_from_start(1, forget=False)
                 elif len(self.list) > 1:
-                    self.remove_from_start(2)
+                    self.remove_from_start(2, forget=False)
                 else:
                     break
                 self.update_system_index()
@@ -140,33 +147,78 @@ class Chatterstack:
         self.system_lock_index = index
         self.move_system_to(index)
 
-
+    def enable_retrieval(self, top_k=3, token_budget=500, min_score=0.2, n_features=1024):
+        """Turn on relevance-based history. Older messages that have been trimmed out of the conversation
+        can be pulled back in when they are relevant to the latest message. Requires numpy."""
+        from retrieval import MessageIndex
+        self.retrieval = True
+        self.retrieval_top_k = top_k
+        self.retrieval_token_budget = token_budget
+        self.retrieval_min_score = min_score
+        self.message_index = MessageIndex(n_features)
+        self.reindex_messages()
+
+    def disable_retrieval(self):
+        self.retrieval = False
+        self.message_index = None
+
+    def index_message(self, message, text=None):
+        # System messages are instructions, not history, so they are never retrieved
+        if self.retrieval and message["role"] != "system":
+            self.message_index.add(message, self.retrieval_text(message["content"]) if text is None else text)
+
+    def retrieval_text(self, content):
+        """The part of a message's content that is used to judge relevance."""
+        return content
+
+    def forget_messages(self, messages):
+        """Remove messages from the retrieval index, so they can't be pulled back into the conversation."""
+        if self.retrieval:
+            for message in messages:
+                self.message_index.remove(message)
+
+    def reindex_messages(self):
+        """Rebuild the retrieval index from the current conversation only."""
+        if self.retrieval:
+            self.message_index.clear()
+            for d in self.list:
+                self.index_message(d)
+
+    def messages_for_bot(self):
+        """Return the messages to send to the API: the current conversation, plus (if retrieval is on) the most relevant older messages."""
+        if not self.retrieval or not self.list:
+            return self.list
+        query = self.retrieval_text(self.last_user_message or self.last_message)
+        retrieved = self.message_index.search(query, self.retrieval_top_k, self.retrieval_token_budget, exclude=self.list, min_score=self.retrieval_min_score)
+        if not retrieved:
+            return self.list
+        self.dbprint(f"RETRIEVED {len(retrieved)} older message(s)")
+        # Retrieved messages are older than everything in the list, so they go right before it.
+        # A leading system message stays in front, anywhere else it keeps its place in the recent messages
+        self.update_system_index()
+        start = 1 if self.system_index == 0 else 0
+        return self.list[:start] + retrieved + self.list[start:]
+
+
+
+    def api_arguments(self, **kwargs):
+        """Return the arguments for an API call, using the defaults for anything not passed."""
+        return {
+            "model": kwargs.get("model", self.config.get("model", "gpt-3.5-turbo")),
+            "temperature": kwargs.get("temperature", self.config.get("temperature", 0.8)),
+            "top_p": kwargs.get("top_p", self.config.get("top_p", 1)),
+            "frequency_penalty": kwargs.get("frequency_penalty", self.config.get("frequency_penalty", 0)),
+            "presence_penalty": kwargs.get("presence_penalty", self.config.get("presence_penalty", 0)),
+            "max_tokens": kwargs.get("max_tokens", self.config.get("max_tokens", 200)),
+            "stop": kwargs.get("stop", self.config.get("stop", None)),
+            "stream": kwargs.get("stream", self.config.get("stream", False)),
+            "logit_bias": kwargs.get("logit_bias", self.config.get("logit_bias", {})),
+        }
 
     def send_to_bot(self, **kwargs):
         """Send the conversation to the OpenAI API and append the response to the end of the conversation. Uses 3.5-turbo by default."""
         self.trim_to_max_length()
-        model = kwargs.get("model", self.config.get("model", "gpt-3.5-turbo"))
-        temperature = kwargs.get("temperature", self.config.get("temperature", 0.8))
-        top_p = kwargs.get("top_p", self.config.get("top_p", 1))
-        frequency_penalty = kwargs.get("frequency_penalty", self.config.get("frequency_penalty", 0))
-        presence_penalty = kwargs.get("presence_penalty", self.config.get("presence_penalty", 0))
-        max_tokens = kwargs.get("max_tokens", self.config.get("max_tokens", 200))
-        stop = kwargs.get("stop", self.config.get("stop", None))
-        stream = kwargs.get("stream", self.config.get("stream", False))
-        logit_bias = kwargs.get("logit_bias", self.config.get("logit_bias", {}))
-
-        response = openai.ChatCompletion.create(
-            model=model,
-            messages=self.list,
-            temperature=temperature,
-            top_p=top_p,
-            frequency_penalty=frequency_penalty,
-            presence_penalty=presence_penalty,
-            max_tokens=max_tokens,
-            stop=stop,
-            stream=stream,
-            logit_bias=logit_bias,
-        )
+        response = openai.ChatCompletion.create(messages=self.messages_for_bot(), **self.api_arguments(**kwargs))
         self.add_assistant(response.choices[0].message.content.strip())
 
         api_usage = response['usage']
@@ -187,15 +239,20 @@ class Chatterstack:
         if count < 0:
             print("Count must be a non-negative integer")
             return
+        old_list = self.list
         self.list = self.list[:-count] if count < len(self.list) else []
+        self.forget_messages(old_list[len(self.list):])
 
 
-    def remove_from_start(self, count):
-        """Remove N messages (count) from the start of the list."""
+    def remove_from_start(self, count, forget=True):
+        """Remove N messages (count) from the start of the list. With forget=False, removed messages can still be retrieved later."""
         if count < 0:
             print("Count must be a non-negative integer")
             return
+        old_list = self.list
         self.list = self.list[count:] if count < len(self.list) else []
+        if forget:
+            self.forget_messages(old_list[:len(old_list) - len(self.list)])
 
 
     def insert(self, index, role, content):
@@ -206,7 +263,9 @@ class Chatterstack:
         if index < 0 or index > len(self.list):
             print("Index out of range")
             return
-        self.list.insert(index, {"role": role, "content": content})
+        new_dict = {"role": role, "content": content}
+        self.list.insert(index, new_dict)
+        self.index_message(new_dict)
 
 
     def move_system_message(self, index, from_end=False):
@@ -269,7 +328,7 @@ class Chatterstack:
             return
         if is_locked:
             return
-        del self.list[message_index]
+        self.forget_messages([self.list.pop(message_index)])
         self.dbprint(f'1 message containing the "{substring}" was removed')
     
     
@@ -337,6 +396,8 @@ class Chatterstack:
     def clear(self):
         """Clear the conversation."""
         self.list = []
+        if self.message_index is not None:
+            self.message_index.clear()
 
 
 
@@ -38,14 +38,21 @@ class ChatterstackAdvanced(Chatterstack):
 
 
     def add(self, role, content):
+        raw_content = content
         if self.timestamps and role != "assistant":
             timestamp = datetime.datetime.now().strftime('%m/%d %H:%M')
             content = f"{timestamp} {content}"
         new_dict = {"role": role, "content": content}
         self.list.insert(len(self.list), new_dict)
+        self.index_message(new_dict, raw_content)
         return self
 
 
+    def retrieval_text(self, content):
+        # leave out the timestamp, so messages match by topic rather than by time
+        return re.sub(r'^[0-1][0-9]/[0-3][0-9] [0-2][0-9]:[0-5][0-9] ', '', content)
+
+
     def user_input(self, prefix="USER: ", parse_commands=None):
         while True:
             if parse_commands is None:
@@ -80,7 +87,8 @@ class ChatterstackAdvanced(Chatterstack):
         raise TimeoutError()
 
 
-    def parse_message_for_commands(self, message):
+    def parse_command(self, message):
+        """Find a command in a message, without running it. Returns (command, args, remaining_message), or (None, [], message) if there is no command."""
         pattern = re.escape(self.open_command) + r'([^' + re.escape(self.close_command) + r'\(]*)' + r'(\([^)]*\))?' + re.escape(self.close_command)
         match = re.search(pattern, message)
         if match:
@@ -93,14 +101,21 @@ class ChatterstackAdvanced(Chatterstack):
                 args = [self.parse_argument(arg) for arg in args_str.split(",")]
             else:
                 args = []
-            if command in self.command_handler.command_map:
-                self.command_handler.execute_command(command)
-            else:
-                call_method_command = CallMethodCommand(self, command, *args)
-                call_method_command.execute()
-            return command, remaining_message if remaining_message else None
+            return command, args, remaining_message if remaining_message else None
         else:
+            return None, [], message
+
+
+    def parse_message_for_commands(self, message):
+        command, args, remaining_message = self.parse_command(message)
+        if command is None:
             return None, message
+        if command in self.command_handler.command_map:
+            self.command_handler.execute_command(command)
+        else:
+            call_method_command = CallMethodCommand(self, command, *args)
+            call_method_command.execute()
+        return command, remaining_message
 
 
     def parse_message_for_reminders(self, message_to_parse=None):
@@ -135,6 +150,7 @@ class ChatterstackAdvanced(Chatterstack):
             for attr in self.__dict__:
                 self.__dict__[attr] = None
         self.list = json.loads(json_string)
+        self.reindex_messages()
 
 
     def get_conversation_duration(self):
@@ -154,17 +170,20 @@ class ChatterstackAdvanced(Chatterstack):
         return remaining_seconds
 
 
-    def send_reminder(self):
+    def send_reminder(self, print_reminder=True):
         title, time = self.next_event
         self.add_system(f"FROM SYSTEM: Generate the reminder message to send to the user now for: [{title}]. This message will be sent to the user via their calender reminder system. (DO NOT create a reminder at the beginning of your response to this message.)")
         self.reminders.remove(self.next_event)
         self.send_to_bot()
         self.remove_message_containing("FROM SYSTEM")
-        self.print_last_message()
+        if print_reminder:
+            self.print_last_message()
 
 
     def change_attribute(self, attribute, new_value):
         setattr(self, attribute, new_value)
+        if attribute == "list":
+            self.reindex_messages()
 
 
     def get_next_event(self):
@@ -223,28 +242,7 @@ class ChatterstackAdvanced(Chatterstack):
         """Send the conversation to the OpenAI API and append the response to the end of the conversation. Uses 3.5-turbo by default."""
         self.trim_to_max_length()
         parse = kwargs.get('parse', None)
-        model = kwargs.get("model", self.config.get("model", "gpt-3.5-turbo"))
-        temperature = kwargs.get("temperature", self.config.get("temperature", 0.8))
-        top_p = kwargs.get("top_p", self.config.get("top_p", 1))
-        frequency_penalty = kwargs.get("frequency_penalty", self.config.get("frequency_penalty", 0))
-        presence_penalty = kwargs.get("presence_penalty", self.config.get("presence_penalty", 0))
-        max_tokens = kwargs.get("max_tokens", self.config.get("max_tokens", 200))
-        stop = kwargs.get("stop", self.config.get("stop", None))
-        stream = kwargs.get("stream", self.config.get("stream", False))
-        logit_bias = kwargs.get("logit_bias", self.config.get("logit_bias", {}))
-
-        response = openai.ChatCompletion.create(
-            model=model,
-            messages=self.list,
-            temperature=temperature,
-            top_p=top_p,
-            frequency_penalty=frequency_penalty,
-            presence_penalty=presence_penalty,
-            max_tokens=max_tokens,
-            stop=stop,
-            stream=stream,
-            logit_bias=logit_bias,
-        )
+        response = openai.ChatCompletion.create(messages=self.messages_for_bot(), **self.api_arguments(**kwargs))
 
         self.dbprint(response.choices[0].message.content.strip())
             
@@ -276,3 +274,29 @@ class ChatterstackAdvanced(Chatterstack):
         self.assistant_tokens_total += self.last_call_completion_tokens
         self.tokens_total_all += self.last_call_tokens_all
         return self
+
+
+    def stream_to_bot(self, parse=None, **kwargs):
+        """Like send_to_bot(), but streams the response. Yields each piece of the response as it arrives, and appends the full response to the conversation at the end.
+        The API does not report token usage for streamed responses, so the token counts are not updated."""
+        self.trim_to_max_length()
+        arguments = self.api_arguments(**kwargs)
+        arguments["stream"] = True
+        response = openai.ChatCompletion.create(messages=self.messages_for_bot(), **arguments)
+
+        pieces = []
+        for chunk in response:
+            piece = chunk["choices"][0]["delta"].get("content")
+            if piece:
+                pieces.append(piece)
+                yield piece
+            self.last_response_time = chunk["created"]
+        message_to_append = "".join(pieces).strip()
+
+        if parse is True or (parse is None and self.parse_for_reminders is True):
+            _, message_to_append = self.parse_message_for_reminders(message_to_append)
+
+        self.add_assistant(message_to_append)
+
+        if self.first_response_time is None:
+            self.first_response_time = self.last_response_time
@@ -0,0 +1,93 @@
+import re, zlib
+import numpy as np
+
+
+# ---------------- --------------------- ---------------- ---------------------
+# RETRIEVAL
+# ---------------- --------------------- ---------------- ---------------------
+
+
+# Common words that say nothing about what a message is about
+STOP_WORDS = {
+    "a", "an", "the", "and", "or", "but", "if", "of", "to", "in", "on", "at", "by", "for", "with", "about",
+    "from", "as", "is", "are", "was", "were", "be", "been", "am", "do", "does", "did", "have", "has", "had",
+    "i", "me", "my", "you", "your", "we", "our", "he", "she", "it", "its", "they", "them", "their",
+    "this", "that", "these", "those", "what", "which", "who", "how", "when", "where", "why",
+    "can", "could", "will", "would", "should", "not", "no", "so", "just", "there", "here",
+}
+
+
+def hash_vectorize(text, n_features=1024):
+    """Turn a string into a normalized hashed bag-of-words vector. Runs locally, no API calls."""
+    vector = np.zeros(n_features, dtype=np.float32)
+    for token in re.findall(r"\w+", text.lower()):
+        if token in STOP_WORDS:
+            continue
+        h = zlib.crc32(token.encode("utf-8"))
+        # the top bit picks the sign, which keeps hash collisions from always piling up on each other
+        vector[h % n_features] += 1.0 if h & 0x80000000 else -1.0
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector /= norm
+    return vector
+
+
+def estimate_tokens(message):
+    """Rough token count for a message (~4 characters per token, plus a little overhead per message)."""
+    return len(message["content"]) // 4 + 4
+
+
+class MessageIndex:
+    def __init__(self, n_features=1024):
+        self.n_features = n_features
+        self.messages = []
+        self.matrix = np.zeros((16, n_features), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.messages)
+
+    def add(self, message, text=None):
+        """Embed a message once and store it in the index. Pass 'text' to embed something other than the message content."""
+        if len(self.messages) == self.matrix.shape[0]:
+            # grow by doubling, so adding messages stays cheap
+            grown = np.zeros((self.matrix.shape[0] * 2, self.n_features), dtype=np.float32)
+            grown[:len(self.messages)] = self.matrix
+            self.matrix = grown
+        self.matrix[len(self.messages)] = hash_vectorize(message["content"] if text is None else text, self.n_features)
+        self.messages.append(message)
+
+    def remove(self, message):
+        """Remove a message (matched by identity) from the index, if it is there."""
+        for i, m in enumerate(self.messages):
+            if m is message:
+                count = len(self.messages)
+                self.matrix[i:count - 1] = self.matrix[i + 1:count]
+                self.matrix[count - 1] = 0
+                del self.messages[i]
+                return
+
+    def search(self, query, top_k=3, token_budget=500, exclude=None, min_score=0.2):
+        """Return up to top_k indexed messages most relevant to the query, fitting inside token_budget, in the order they were added.
+        Messages scoring below min_score (cosine similarity, 0 to 1) or in 'exclude' (matched by identity) are skipped."""
+        if not self.messages or top_k <= 0:
+            return []
+        excluded_ids = {id(m) for m in (exclude or [])}
+        scores = self.matrix[:len(self.messages)] @ hash_vectorize(query, self.n_features)
+        picked = []
+        tokens_used = 0
+        for i in np.argsort(-scores, kind="stable"):
+            if len(picked) >= top_k or scores[i] < min_score or scores[i] <= 0:
+                break
+            message = self.messages[i]
+            if id(message) in excluded_ids:
+                continue
+            message_tokens = estimate_tokens(message)
+            if tokens_used + message_tokens > token_budget:
+                continue
+            picked.append(i)
+            tokens_used += message_tokens
+        return [self.messages[i] for i in sorted(picked)]
+
+    def clear(self):
+        self.messages = []
+        self.matrix = np.zeros((16, self.n_features), dtype=np.float32)
@@ -0,0 +1,439 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+import multiprocessing, threading, argparse, itertools, queue, json, time, zlib
+import openai
+
+
+# ---------------- --------------------- ---------------- ---------------------
+# SESSION SERVER
+# ---------------- --------------------- ---------------- ---------------------
+#
+# Runs many ChatterstackAdvanced conversations behind a local HTTP API.
+# Conversations are sharded across worker processes by conversation id, so
+# every conversation always lives in the same process, and a host can use
+# all of its cores. Inside a worker, different conversations run at the same
+# time on a thread pool, while jobs for one conversation run one after another.
+#
+#   python server.py --port 8000 --workers 4
+#
+#   POST   /conversations/<id>/add               {"role": "user", "content": "hi"}
+#   POST   /conversations/<id>/send              {"model": "gpt-4", ...}  (any send_to_bot arguments)
+#   POST   /conversations/<id>/stream            same as send, but answers with server-sent events
+#   POST   /conversations/<id>/command           {"text": "[set_max_length(6)] hello"}
+#   GET    /conversations/<id>/reminders
+#   POST   /conversations/<id>/reminders/send
+#   GET    /conversations/<id>
+#   DELETE /conversations/<id>
+
+
+# Methods that can be called with a command through the server. Anything else could
+# rewrite attributes, write files, or make extra API calls on the server's account.
+SERVER_METHODS = {
+    "set_max_length",
+    "set_system_lock_index",
+    "move_system_to_end",
+    "remove_from_start",
+    "remove_from_end",
+    "disable_retrieval",
+    "clear",
+}
+
+# Arguments that can be passed to /send and /stream
+SEND_ARGUMENTS = {"model", "temperature", "top_p", "frequency_penalty", "presence_penalty", "max_tokens", "stop", "logit_bias", "parse"}
+
+# Actions that start a new conversation if the id is unknown
+CREATING_ACTIONS = {"add", "send", "stream", "command"}
+
+
+class UnknownConversation(Exception):
+    pass
+
+
+class BadRequest(Exception):
+    pass
+
+
+def enable_retrieval(convo, top_k=3, token_budget=500, min_score=0.2):
+    """enable_retrieval() with limits, so one request can't use up a worker's memory. The index size is fixed."""
+    if not isinstance(top_k, int) or not 0 < top_k <= 20:
+        raise BadRequest("top_k must be an integer from 1 to 20")
+    if not isinstance(token_budget, int) or not 0 < token_budget <= 4000:
+        raise BadRequest("token_budget must be an integer from 1 to 4000")
+    if not isinstance(min_score, (int, float)) or not 0 <= min_score <= 1:
+        raise BadRequest("min_score must be a number from 0 to 1")
+    convo.enable_retrieval(top_k, token_budget, min_score)
+
+
+# Commands that go through a server-side wrapper instead of calling the method directly
+SERVER_WRAPPERS = {"enable_retrieval": enable_retrieval}
+
+
+def new_conversation(user_defaults):
+    from chatterstackadvanced import ChatterstackAdvanced
+    convo = ChatterstackAdvanced(user_defaults)
+    # [quit] would take down the whole worker process, and [save] has every conversation write to the same file
+    convo.command_handler.command_map.pop('quit', None)
+    convo.command_handler.command_map.pop('save', None)
+    return convo
+
+
+def run_command(convo, text):
+    if not isinstance(text, str):
+        raise BadRequest("'text' must be a string")
+    command, args, remaining_message = convo.parse_command(text)
+    if command is not None:
+        if command in convo.command_handler.command_map:
+            convo.command_handler.execute_command(command)
+        elif command in SERVER_WRAPPERS:
+            SERVER_WRAPPERS[command](convo, *args)
+        elif command in SERVER_METHODS:
+            try:
+                getattr(convo, command)(*args)
+            except (TypeError, ValueError) as e:
+                raise BadRequest(f"Command '{command}' failed: {e}")
+        else:
+            raise BadRequest(f"Command '{command}' is not available")
+    if remaining_message:
+        convo.add_user(remaining_message)
+    return {"command": command, "message": remaining_message}
+
+
+def check_send_arguments(args):
+    unknown = set(args) - SEND_ARGUMENTS
+    if unknown:
+        raise BadRequest(f"Unknown arguments: {', '.join(sorted(unknown))}")
+
+
+def run_action(convo, action, args, send_chunk=None):
+    if action == "add":
+        if args.get("role") not in {"system", "user", "assistant"} or not isinstance(args.get("content"), str):
+            raise BadRequest("'add' needs a 'role' (system, user or assistant) and a string 'content'")
+        convo.add(args["role"], args["content"])
+    elif action == "send":
+        if args.get("stream"):
+            raise BadRequest("Use the /stream endpoint to stream responses")
+        check_send_arguments(args)
+        convo.send_to_bot(**args)
+        return {"message": convo.last_message, "summary": convo.summary()}
+    elif action == "stream":
+        args.pop("stream", None)
+        check_send_arguments(args)
+        for piece in convo.stream_to_bot(**args):
+            send_chunk(piece)
+        return {"message": convo.last_message, "summary": convo.summary()}
+    elif action == "command":
+        return run_command(convo, args.get("text"))
+    elif action == "reminders":
+        next_event, seconds_remaining = convo.get_next_event()
+        return {"reminders": convo.reminders, "next_event": next_event, "seconds_remaining": seconds_remaining}
+    elif action == "send_reminder":
+        next_event, _ = convo.get_next_event()
+        if next_event is None:
+            raise BadRequest("No upcoming reminder")
+        convo.send_reminder(print_reminder=False)
+        return {"reminder": next_event, "message": convo.last_message}
+    elif action != "get":
+        raise BadRequest(f"Unknown action '{action}'")
+    return {"messages": convo.list}
+
+
+class Worker:
+    def __init__(self, inbox, outbox, user_defaults, threads, max_conversations):
+        self.inbox = inbox
+        self.outbox = outbox
+        self.user_defaults = user_defaults
+        self.max_conversations = max_conversations
+        self.conversations = OrderedDict()  # least recently used first
+        self.waiting = {}  # conversation id -> jobs queued behind the one that is running
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(threads)
+
+    def run(self):
+        while True:
+            job = self.inbox.get()
+            if job is None:
+                break
+            conversation_id = job[1]
+            with self.lock:
+                if conversation_id in self.waiting:
+                    self.waiting[conversation_id].append(job)
+                    continue
+                self.waiting[conversation_id] = deque()
+            self.executor.submit(self.run_jobs, job)
+        self.executor.shutdown()
+
+    def run_jobs(self, job):
+        """Run a job, then any jobs that queued up for the same conversation meanwhile."""
+        conversation_id = job[1]
+        while job is not None:
+            self.outbox.put(self.run_job(*job))
+            with self.lock:
+                if self.waiting[conversation_id]:
+                    job = self.waiting[conversation_id].popleft()
+                else:
+                    del self.waiting[conversation_id]
+                    job = None
+
+    def get_conversation(self, conversation_id, action):
+        with self.lock:
+            if conversation_id in self.conversations:
+                self.conversations.move_to_end(conversation_id)
+                if action == "delete":
+                    return self.conversations.pop(conversation_id)
+                return self.conversations[conversation_id]
+            if action not in CREATING_ACTIONS:
+                raise UnknownConversation(f"No conversation '{conversation_id}'")
+            convo = self.conversations[conversation_id] = new_conversation(self.user_defaults)
+            # drop the least recently used conversations that have nothing running
+            idle = [i for i in self.conversations if i not in self.waiting]
+            for i in idle[:max(0, len(self.conversations) - self.max_conversations)]:
+                del self.conversations[i]
+            return convo
+
+    def run_job(self, job_id, conversation_id, action, args):
+        try:
+            convo = self.get_conversation(conversation_id, action)
+            if action == "delete":
+                return job_id, 200, {"deleted": conversation_id}
+            send_chunk = lambda piece: self.outbox.put((job_id, None, piece))
+            return job_id, 200, run_action(convo, action, args, send_chunk)
+        except UnknownConversation as e:
+            return job_id, 404, {"error": str(e)}
+        except BadRequest as e:
+            return job_id, 400, {"error": str(e)}
+        except openai.error.OpenAIError as e:
+            return job_id, 502, {"error": f"{type(e).__name__}: {e}"}
+        except Exception as e:
+            return job_id, 500, {"error": f"{type(e).__name__}: {e}"}
+
+
+def worker(inbox, outbox, initializer, user_defaults, threads, max_conversations):
+    """Worker process entry point. Owns every conversation that is sharded to it."""
+    if initializer is not None:
+        initializer()
+    Worker(inbox, outbox, user_defaults, threads, max_conversations).run()
+
+
+class SessionPool:
+    def __init__(self, workers=None, max_pending=256, user_defaults=None, threads=32, max_conversations=10000, start_method=None, initializer=None):
+        """Start the worker processes. Each worker accepts at most max_pending unfinished jobs before requests are refused,
+        and keeps at most max_conversations conversations, dropping the least recently used ones.
+        start_method picks how workers are started ("fork", "spawn", ...), and initializer is called in each worker as it starts."""
+        self.max_pending = max_pending
+        self.context = multiprocessing.get_context(start_method)
+        self.worker_args = (initializer, user_defaults or {}, threads, max_conversations)
+        self.pending = []
+        self.jobs = {}  # job id -> (shard, queue the job's events go to, or None once nobody is waiting)
+        self.lock = threading.Lock()
+        self.job_ids = itertools.count()
+        self.inboxes = []
+        self.processes = []
+        self.outbox = self.context.Queue()
+        self.closing = False
+        for shard in range(workers or multiprocessing.cpu_count()):
+            self.inboxes.append(None)
+            self.processes.append(None)
+            self.pending.append(0)
+            self.start_worker(shard)
+        self.collector = threading.Thread(target=self.collect_results, daemon=True)
+        self.collector.start()
+
+    def start_worker(self, shard):
+        self.inboxes[shard] = self.context.Queue()
+        self.processes[shard] = self.context.Process(target=worker, args=(self.inboxes[shard], self.outbox) + self.worker_args, daemon=True)
+        self.processes[shard].start()
+
+    def shard_for(self, conversation_id):
+        return zlib.crc32(conversation_id.encode("utf-8")) % len(self.inboxes)
+
+    def submit(self, conversation_id, action, args=None):
+        """Queue a job on the conversation's worker. Returns (job_id, events), or None if that worker is saturated.
+        'events' is a queue of (status, body) pairs: status None for a streamed chunk, then a final HTTP status."""
+        shard = self.shard_for(conversation_id)
+        events = queue.Queue()
+        with self.lock:
+            if self.pending[shard] >= self.max_pending:
+                return None
+            self.pending[shard] += 1
+            job_id = next(self.job_ids)
+            self.jobs[job_id] = (shard, events)
+            self.inboxes[shard].put((job_id, conversation_id, action, args or {}))
+        return job_id, events
+
+    def abandon(self, job_id):
+        """Stop waiting for a job (timed out, or the client went away). The job still holds its pending slot
+        until the worker finishes it, so a slow backend keeps applying backpressure."""
+        with self.lock:
+            if job_id in self.jobs:
+                shard, _ = self.jobs[job_id]
+                self.jobs[job_id] = (shard, None)
+
+    def collect_results(self):
+        last_check = time.monotonic()
+        while True:
+            if time.monotonic() - last_check > 0.5:
+                self.check_workers()
+                last_check = time.monotonic()
+            try:
+                result = self.outbox.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if result is None:
+                break
+            job_id, status, body = result
+            with self.lock:
+                if job_id not in self.jobs:
+                    continue
+                shard, events = self.jobs[job_id]
+                if status is not None:
+                    del self.jobs[job_id]
+                    self.pending[shard] -= 1
+            if events is not None:
+                events.put((status, body))
+
+    def check_workers(self):
+        """Restart any worker process that has died, and fail the jobs it was holding."""
+        with self.lock:
+            if self.closing:
+                return
+            for shard, process in enumerate(self.processes):
+                if process.is_alive():
+                    continue
+                for job_id, (job_shard, events) in list(self.jobs.items()):
+                    if job_shard == shard:
+                        del self.jobs[job_id]
+                        if events is not None:
+                            events.put((500, {"error": "Worker process died"}))
+                self.pending[shard] = 0
+                self.start_worker(shard)
+
+    def close(self):
+        with self.lock:
+            self.closing = True
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for process in self.processes:
+            process.join()
+        self.outbox.put(None)
+        self.collector.join()
+
+
+class SessionRequestHandler(BaseHTTPRequestHandler):
+    # (method, trailing path) -> worker action
+    routes = {
+        ("POST", "add"): "add",
+        ("POST", "send"): "send",
+        ("POST", "stream"): "stream",
+        ("POST", "command"): "command",
+        ("GET", "reminders"): "reminders",
+        ("POST", "reminders/send"): "send_reminder",
+        ("GET", ""): "get",
+        ("DELETE", ""): "delete",
+    }
+
+    def do_GET(self):
+        self.handle_route("GET")
+
+    def do_POST(self):
+        self.handle_route("POST")
+
+    def do_DELETE(self):
+        self.handle_route("DELETE")
+
+    def handle_route(self, method):
+        parts = self.path.strip("/").split("/", 2)
+        if len(parts) < 2 or parts[0] != "conversations" or not parts[1]:
+            return self.send_json(404, {"error": "Not found"})
+        conversation_id = parts[1]
+        action = self.routes.get((method, parts[2] if len(parts) > 2 else ""))
+        if action is None:
+            return self.send_json(404, {"error": "Not found"})
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            if length < 0:
+                raise ValueError("negative Content-Length")
+            args = json.loads(self.rfile.read(length)) if length else {}
+        except ValueError:
+            return self.send_json(400, {"error": "Invalid Content-Length or JSON body"})
+        if not isinstance(args, dict):
+            return self.send_json(400, {"error": "JSON body must be an object"})
+
+        submitted = self.server.pool.submit(conversation_id, action, args)
+        if submitted is None:
+            return self.send_json(503, {"error": "Server busy, try again"}, {"Retry-After": "1"})
+        job_id, events = submitted
+        streaming = False
+        try:
+            status, body = events.get(timeout=self.server.request_timeout)
+            # status None means a streamed chunk
+            while status is None:
+                if not streaming:
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/event-stream")
+                    self.send_header("Cache-Control", "no-cache")
+                    self.end_headers()
+                    streaming = True
+                self.send_event("message", body)
+                status, body = events.get(timeout=self.server.request_timeout)
+            if streaming:
+                self.send_event("done" if status == 200 else "error", body)
+            else:
+                self.send_json(status, body)
+        except queue.Empty:
+            self.server.pool.abandon(job_id)
+            if streaming:
+                self.send_event("error", {"error": "Timed out waiting for worker"})
+            else:
+                self.send_json(504, {"error": "Timed out waiting for worker"})
+        except (BrokenPipeError, ConnectionResetError):
+            self.server.pool.abandon(job_id)
+
+    def send_event(self, event, body):
+        self.wfile.write(f"event: {event}\ndata: {json.dumps(body)}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class SessionServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, pool, request_timeout=120):
+        super().__init__(address, SessionRequestHandler)
+        self.pool = pool
+        self.request_timeout = request_timeout
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve chatterstack conversations over a local HTTP API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: one per core)")
+    parser.add_argument("--threads", type=int, default=32, help="conversations each worker runs at the same time")
+    parser.add_argument("--max-pending", type=int, default=256, help="unfinished requests per worker before returning 503")
+    parser.add_argument("--max-conversations", type=int, default=10000, help="conversations kept per worker before dropping the least recently used")
+    args = parser.parse_args()
+
+    pool = SessionPool(args.workers, args.max_pending, threads=args.threads, max_conversations=args.max_conversations)
+    server = SessionServer((args.host, args.port), pool)
+    print(f"Serving chatterstack on http://{args.host}:{args.port} with {len(pool.processes)} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,13 @@
+from unittest import mock
+import os, sys
+
+# the modules import each other by name (from chatterstack import *), so they need to be on the path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "chatterstack"))
+
+
+class FakeResponse(dict):
+    """Looks enough like an openai.ChatCompletion.create() response for chatterstack."""
+    def __init__(self, content):
+        super().__init__(usage={"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15})
+        self.choices = [mock.Mock(message=mock.Mock(content=content))]
+        self.created = 1
@@ -0,0 +1,144 @@
+from unittest import mock
+import openai
+import pytest
+
+from chatterstack import Chatterstack
+from chatterstackadvanced import ChatterstackAdvanced
+from retrieval import MessageIndex
+from conftest import FakeResponse
+
+
+@pytest.fixture
+def fake_create():
+    with mock.patch.object(openai.ChatCompletion, "create", return_value=FakeResponse("ok")) as create:
+        yield create
+
+
+def make_index(*texts):
+    index = MessageIndex()
+    messages = [{"role": "user", "content": text} for text in texts]
+    for message in messages:
+        index.add(message)
+    return index, messages
+
+
+def test_search_respects_top_k():
+    index, messages = make_index("apples are red", "apples are green", "apples are sweet", "cars are fast")
+    assert len(index.search("apples", top_k=2)) == 2
+
+
+def test_search_returns_messages_in_order_added():
+    index, messages = make_index("dogs bark", "the weather is nice", "my dog is a beagle dog")
+    # the last message is the better match, but results come back in conversation order
+    assert index.search("dog dogs beagle", top_k=2) == [messages[0], messages[2]]
+
+
+def test_search_skips_messages_over_budget():
+    index, messages = make_index("python " * 200, "python is nice")
+    assert index.search("python", top_k=2, token_budget=20) == [messages[1]]
+
+
+def test_search_excludes_by_identity():
+    index, messages = make_index("apples are red", "apples are green")
+    # an equal but different dict is not excluded
+    assert index.search("apples", exclude=[{"role": "user", "content": "apples are red"}]) == messages
+    assert index.search("apples", exclude=[messages[0]]) == [messages[1]]
+
+
+def test_search_ignores_unrelated_messages():
+    index, _ = make_index("cars are fast", "tell me about the moon", "the weather is nice")
+    assert index.search("apples") == []
+    # sharing only common words doesn't count
+    assert index.search("what is the capital") == []
+
+
+def test_search_min_score():
+    index, messages = make_index("apples bananas cherries dates figs grapes")
+    assert index.search("apples", min_score=0.2) == messages
+    assert index.search("apples", min_score=0.5) == []
+
+
+def test_remove_by_identity():
+    index, messages = make_index("apples are red", "apples are green", "apples are sweet")
+    index.remove({"role": "user", "content": "apples are green"})
+    assert len(index) == 3
+    index.remove(messages[1])
+    assert index.search("apples", top_k=5) == [messages[0], messages[2]]
+
+
+def test_trimmed_messages_are_retrieved(fake_create):
+    convo = Chatterstack()
+    convo.enable_retrieval(top_k=1)
+    convo.add_user("my cat is called Biscuit")
+    convo.add_assistant("Biscuit is a lovely name")
+    convo.add_user("what is the capital of France")
+    convo.add_assistant("Paris")
+    convo.add_user("what was my cat called")
+    convo.set_max_length(2)
+    convo.send_to_bot()
+    sent = fake_create.call_args.kwargs["messages"]
+    assert sent[0]["content"] == "my cat is called Biscuit"
+    assert sent[1:] == convo.list[:-1]
+
+
+def test_removed_messages_are_not_retrieved(fake_create):
+    convo = Chatterstack()
+    convo.enable_retrieval()
+    convo.add_user("my cat is called Biscuit")
+    convo.add_user("what was my cat called")
+    convo.remove_message_containing("Biscuit")
+    convo.send_to_bot()
+    assert fake_create.call_args.kwargs["messages"][0]["content"] == "what was my cat called"
+
+
+def test_retrieved_messages_go_after_leading_system_message(fake_create):
+    convo = Chatterstack()
+    convo.enable_retrieval()
+    convo.add_system("be brief")
+    convo.add_user("my cat is called Biscuit")
+    convo.add_assistant("nice")
+    convo.add_user("hello")
+    convo.add_user("what was my cat called")
+    # keep the system message and the last two messages, as if the rest had been trimmed
+    convo.list = [convo.list[0]] + convo.list[-2:]
+    convo.set_max_length(None)
+    convo.send_to_bot()
+    sent = fake_create.call_args.kwargs["messages"]
+    assert [m["content"] for m in sent] == ["be brief", "my cat is called Biscuit", "hello", "what was my cat called"]
+
+
+def test_system_message_keeps_position_from_end(fake_create):
+    convo = Chatterstack()
+    convo.enable_retrieval()
+    convo.add_user("my cat is called Biscuit")
+    convo.add_assistant("nice")
+    convo.add_user("cat food")
+    convo.add_system("be brief")
+    convo.add_user("what was my cat called")
+    convo.set_system_lock_index(-1)
+    convo.set_max_length(4)
+    convo.trim_to_max_length()
+    window = list(convo.list)
+    convo.send_to_bot()
+    sent = fake_create.call_args.kwargs["messages"]
+    assert sent[0]["content"] == "my cat is called Biscuit"
+    assert sent[1:] == window
+
+
+def test_timestamp_is_left_out_of_query():
+    convo = ChatterstackAdvanced()
+    convo.enable_retrieval()
+    convo.timestamps = True
+    convo.add_user("hello")
+    with mock.patch.object(convo.message_index, "search", return_value=[]) as search:
+        convo.messages_for_bot()
+    assert search.call_args.args[0] == "hello"
+
+
+def test_timestamps_are_not_indexed():
+    convo = ChatterstackAdvanced()
+    convo.enable_retrieval()
+    convo.timestamps = True
+    convo.add_user("pizza toppings")
+    convo.timestamps = False
+    assert convo.message_index.search(convo.list[0]["content"][:11]) == []
@@ -0,0 +1,242 @@
+from concurrent.futures import ThreadPoolExecutor
+import http.client, json, multiprocessing, os, signal, threading, time, urllib.error, urllib.request
+import openai
+import pytest
+
+from server import SessionPool, SessionServer
+from conftest import FakeResponse
+
+
+# Workers are forked, and the fake backend is installed by the worker initializer,
+# so it is in place in every worker (restarted ones too) on every platform
+FORK = multiprocessing.get_context("fork")
+
+
+class FakeBackend:
+    """Stands in for openai.ChatCompletion.create in the workers, and echoes the last message back.
+    'slow' waits for release, 'hang' never returns, 'fail' raises an API error, and 'broken' returns a response chatterstack can't read."""
+    def __init__(self):
+        self.slow_calls = FORK.Value("i", 0)
+        self.released = FORK.Event()
+
+    def install(self):
+        openai.ChatCompletion.create = self.create
+
+    def create(self, messages, stream=False, **kwargs):
+        last = messages[-1]["content"]
+        if "slow" in last or "hang" in last:
+            with self.slow_calls.get_lock():
+                self.slow_calls.value += 1
+        if "slow" in last:
+            self.released.wait(10)
+        if "hang" in last:
+            # not waiting on 'released', since a killed waiter would make released.set() block
+            time.sleep(60)
+        if "fail" in last:
+            raise openai.error.APIError("backend down")
+        if "broken" in last:
+            return {}
+        if stream:
+            return iter([{"choices": [{"delta": {"content": word + " "}}], "created": 1} for word in last.split()])
+        return FakeResponse(f"echo: {last}")
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def backend():
+    return FakeBackend()
+
+
+@pytest.fixture
+def start_server(backend):
+    started = []
+
+    def start(request_timeout=10, **pool_args):
+        pool = SessionPool(start_method="fork", initializer=backend.install, **pool_args)
+        server = SessionServer(("127.0.0.1", 0), pool, request_timeout=request_timeout)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        started.append(server)
+        return server
+
+    yield start
+    backend.released.set()
+    for server in started:
+        server.shutdown()
+        server.server_close()
+        server.pool.close()
+
+
+def request(server, method, path, body=None):
+    """Returns (status, headers, body). Server-sent events come back as a list of (event, data) pairs."""
+    data = json.dumps(body).encode("utf-8") if body is not None else None
+    url = f"http://127.0.0.1:{server.server_address[1]}{path}"
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=data, method=method)) as response:
+            status, headers, text = response.status, response.headers, response.read().decode("utf-8")
+    except urllib.error.HTTPError as e:
+        status, headers, text = e.code, e.headers, e.read().decode("utf-8")
+    if headers["Content-Type"] == "text/event-stream":
+        events = []
+        for block in text.strip().split("\n\n"):
+            event, data = block.split("\n")
+            events.append((event[len("event: "):], json.loads(data[len("data: "):])))
+        return status, headers, events
+    return status, headers, json.loads(text)
+
+
+def test_same_conversation_always_uses_same_shard(start_server):
+    pool = start_server(workers=3).pool
+    assert pool.shard_for("abc") == pool.shard_for("abc")
+    assert {pool.shard_for(str(i)) for i in range(30)} == {0, 1, 2}
+
+
+def test_add_send_and_get(start_server):
+    server = start_server(workers=2)
+    assert request(server, "POST", "/conversations/a/add", {"role": "user", "content": "hi"})[0] == 200
+    status, _, body = request(server, "POST", "/conversations/a/send", {})
+    assert (status, body["message"]) == (200, "echo: hi")
+    assert request(server, "GET", "/conversations/a")[2]["messages"][-1] == {"role": "assistant", "content": "echo: hi"}
+
+
+def test_commands_are_restricted(start_server):
+    server = start_server(workers=1)
+    status, _, body = request(server, "POST", "/conversations/a/command", {"text": "[set_max_length(6)] hello"})
+    assert (status, body) == (200, {"command": "set_max_length", "message": "hello"})
+    for text in ["[save]", "[quit]", "[change_attribute('list', 5)]", "[imagine_api('x', 'y')]"]:
+        assert request(server, "POST", "/conversations/a/command", {"text": text})[0] == 400
+    assert request(server, "POST", "/conversations/a/command", {"text": "[set_max_length(1, 2)]"})[0] == 400
+    assert request(server, "GET", "/conversations/a")[2]["messages"] == [{"role": "user", "content": "hello"}]
+
+
+def test_delete_and_least_recently_used_limit(start_server):
+    server = start_server(workers=1, max_conversations=2)
+    for conversation_id in ["a", "b", "c"]:
+        request(server, "POST", f"/conversations/{conversation_id}/add", {"role": "user", "content": "hi"})
+    assert request(server, "GET", "/conversations/a")[0] == 404
+    assert request(server, "DELETE", "/conversations/b")[0] == 200
+    assert request(server, "GET", "/conversations/b")[0] == 404
+    assert request(server, "GET", "/conversations/c")[0] == 200
+
+
+def test_stream(start_server):
+    server = start_server(workers=1)
+    request(server, "POST", "/conversations/a/add", {"role": "user", "content": "one two"})
+    status, _, events = request(server, "POST", "/conversations/a/stream", {})
+    assert status == 200
+    assert events[:2] == [("message", "one "), ("message", "two ")]
+    assert events[2][0] == "done" and events[2][1]["message"] == "one two"
+
+
+def test_send_reminder(start_server):
+    server = start_server(workers=1)
+    request(server, "POST", "/conversations/a/add", {"role": "user", "content": "hi"})
+    assert request(server, "POST", "/conversations/a/reminders/send")[0] == 400
+    # the fake backend echoes this back, and the reply gets parsed for reminders
+    request(server, "POST", "/conversations/a/add", {"role": "user", "content": "{{garbage|12/31 23:59}}"})
+    request(server, "POST", "/conversations/a/send", {})
+    assert request(server, "GET", "/conversations/a/reminders")[2]["reminders"] == [["garbage", "12/31 23:59"]]
+    status, _, body = request(server, "POST", "/conversations/a/reminders/send")
+    assert (status, body["reminder"]) == (200, ["garbage", "12/31 23:59"])
+    assert request(server, "GET", "/conversations/a/reminders")[2]["reminders"] == []
+
+
+def test_conversations_in_one_worker_run_concurrently(start_server, backend):
+    server = start_server(workers=1)
+    for i in range(4):
+        request(server, "POST", f"/conversations/{i}/add", {"role": "user", "content": "slow"})
+    with ThreadPoolExecutor(4) as executor:
+        sends = [executor.submit(request, server, "POST", f"/conversations/{i}/send", {}) for i in range(4)]
+        # all four calls are waiting in the backend at once
+        wait_for(lambda: backend.slow_calls.value == 4)
+        backend.released.set()
+        assert [send.result()[0] for send in sends] == [200] * 4
+
+
+def test_jobs_for_one_conversation_run_in_order(start_server, backend):
+    server = start_server(workers=1)
+    request(server, "POST", "/conversations/a/add", {"role": "user", "content": "slow"})
+    with ThreadPoolExecutor(2) as executor:
+        send = executor.submit(request, server, "POST", "/conversations/a/send", {})
+        wait_for(lambda: backend.slow_calls.value == 1)
+        add = executor.submit(request, server, "POST", "/conversations/a/add", {"role": "user", "content": "after"})
+        wait_for(lambda: server.pool.pending == [2])
+        backend.released.set()
+        assert (send.result()[0], add.result()[0]) == (200, 200)
+    contents = [m["content"] for m in request(server, "GET", "/conversations/a")[2]["messages"]]
+    assert contents == ["slow", "echo: slow", "after"]
+
+
+def test_busy_worker_returns_503(start_server, backend):
+    server = start_server(workers=1, max_pending=1)
+    request(server, "POST", "/conversations/a/add", {"role": "user", "content": "slow"})
+    with ThreadPoolExecutor(1) as executor:
+        send = executor.submit(request, server, "POST", "/conversations/a/send", {})
+        wait_for(lambda: backend.slow_calls.value == 1)
+        status, headers, _ = request(server, "GET", "/conversations/a")
+        backend.released.set()
+        assert send.result()[0] == 200
+    assert status == 503
+    assert headers["Retry-After"] == "1"
+    assert request(server, "GET", "/conversations/a")[0] == 200
+
+
+def test_timed_out_job_keeps_its_slot(start_server, backend):
+    server = start_server(workers=1, max_pending=1, request_timeout=0.2)
+    request(server, "POST", "/conversations/a/add", {"role": "user", "content": "slow"})
+    assert request(server, "POST", "/conversations/a/send", {})[0] == 504
+    # the job is still running in the worker, so the worker is still full
+    assert request(server, "GET", "/conversations/a")[0] == 503
+    backend.released.set()
+    wait_for(lambda: server.pool.pending == [0])
+    assert request(server, "GET", "/conversations/a")[2]["messages"][-1]["content"] == "echo: slow"
+
+
+def test_error_mapping(start_server):
+    server = start_server(workers=1)
+    assert request(server, "GET", "/conversations/unknown")[0] == 404
+    assert request(server, "POST", "/conversations/a/add", {"role": "user"})[0] == 400
+    assert request(server, "POST", "/conversations/a/add", {"role": "robot", "content": "hi"})[0] == 400
+    assert request(server, "POST", "/conversations/a/command", {})[0] == 400
+    assert request(server, "POST", "/conversations/a/send", {"stream": True})[0] == 400
+    assert request(server, "POST", "/conversations/a/send", {"messages": []})[0] == 400
+    request(server, "POST", "/conversations/a/add", {"role": "user", "content": "fail"})
+    assert request(server, "POST", "/conversations/a/send", {})[0] == 502
+    request(server, "POST", "/conversations/a/add", {"role": "user", "content": "broken"})
+    assert request(server, "POST", "/conversations/a/send", {})[0] == 500
+
+
+def test_negative_content_length(start_server):
+    server = start_server(workers=1)
+    connection = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=5)
+    connection.putrequest("POST", "/conversations/a/add")
+    connection.putheader("Content-Length", "-1")
+    connection.endheaders()
+    assert connection.getresponse().status == 400
+    connection.close()
+
+
+def test_enable_retrieval_is_limited(start_server):
+    server = start_server(workers=1)
+    assert request(server, "POST", "/conversations/a/command", {"text": "[enable_retrieval(3, 500, 1000000000)]"})[0] == 400
+    assert request(server, "POST", "/conversations/a/command", {"text": "[enable_retrieval(1000000, 500)]"})[0] == 400
+    assert request(server, "POST", "/conversations/a/command", {"text": "[enable_retrieval(3, 500, 0.3)]"})[0] == 200
+
+
+def test_dead_worker_is_restarted(start_server, backend):
+    server = start_server(workers=1)
+    request(server, "POST", "/conversations/a/add", {"role": "user", "content": "hang"})
+    with ThreadPoolExecutor(1) as executor:
+        send = executor.submit(request, server, "POST", "/conversations/a/send", {})
+        wait_for(lambda: backend.slow_calls.value == 1)
+        os.kill(server.pool.processes[0].pid, signal.SIGKILL)
+        assert send.result()[0] == 500
+    assert server.pool.pending == [0]
+    # the restarted worker gets the fake backend too
+    request(server, "POST", "/conversations/b/add", {"role": "user", "content": "hi"})
+    assert request(server, "POST", "/conversations/b/send", {})[2]["message"] == "echo: hi"